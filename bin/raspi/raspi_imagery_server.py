@@ -49,6 +49,10 @@ except ImportError:
 HOST = ''
 PORT = 18765
 
+# The video port keeps the encoder running between captures and is much faster
+# than the still port, at the cost of some image quality (no still-port denoising).
+USE_VIDEO_PORT = False
+
 IMAGE_POST_URL = "{}upload_imagery/".format(BASE_URL)
 TELEMETRY_URL = "{}telemetry/".format(BASE_URL)
 CJR_URL = "{}cjr/".format(BASE_URL)
@@ -389,6 +393,82 @@ class DeathcryPublisher(RegisteredThreadWithHeartbeat):
         self.deathcries.put(deathcry)
 
 
+class ImageUploader(RegisteredThreadWithHeartbeat):
+    """
+    Posts captured images to the server so that the thread doing the capturing
+    doesn't have to wait on the network.  The queue is small and put() blocks when
+    it is full: if uploads fall behind, capturing slows down rather than images
+    being dropped.  An image is only dropped (and logged) if the uploader thread is
+    dead or closing, or the queue stays full for put_timeout seconds.  Anything
+    queued before abort() is still posted before the thread exits.
+    """
+
+    def __init__(self,
+                 post_method, thread_registry,
+                 queue_size=2,
+                 put_timeout=60,
+                 *args, **kwargs):
+        super(ImageUploader, self).__init__(
+            name='image_uploader',
+            thread_registry=thread_registry,
+            heartbeat_interval=0,
+            *args, **kwargs)
+
+        self.uploads = Queue.Queue(maxsize=queue_size)
+        self.post_method = post_method
+        self.put_timeout = put_timeout
+
+        # add_upload holds this while it checks _closing and queues, so nothing can
+        # be queued after abort() and miss the final drain in _post_run.
+        self._closing = False
+        self._closing_lock = threading.Lock()
+
+    def _heartbeat_run(self):
+        try:
+            payload, files = self.uploads.get(timeout=0.5)
+        except Queue.Empty:
+            return
+        self._upload(payload, files)
+
+    def _post_run(self):
+        while True:
+            try:
+                payload, files = self.uploads.get_nowait()
+            except Queue.Empty:
+                break
+            self._upload(payload, files)
+
+    def _upload(self, payload, files):
+        image_start_post_time = time.time()
+        try:
+            result = self.post_method(payload=payload, files=files)
+            logger.info(result)
+            logger.info("image {} posted in {} seconds".format(payload['filename'],
+                                                               time.time() - image_start_post_time))
+        except Exception:
+            logger.exception("Failed to post image {}.".format(payload['filename']))
+        finally:
+            self.uploads.task_done()
+
+    def add_upload(self, payload, files):
+        with self._closing_lock:
+            if self._closing or not self.is_alive():
+                logger.error("Image uploader is not running; dropping image {}.".format(
+                    payload['filename']))
+                return
+
+            try:
+                self.uploads.put((payload, files), timeout=self.put_timeout)
+            except Queue.Full:
+                logger.error("Image upload queue stayed full for {} seconds; dropping image {}.".format(
+                    self.put_timeout, payload['filename']))
+
+    def abort(self):
+        with self._closing_lock:
+            self._closing = True
+        super(ImageUploader, self).abort()
+
+
 class CaptureJobController(RegisteredThreadWithHeartbeat):
     def __init__(self,
                  imagery_server,
@@ -584,17 +664,38 @@ class Telemeter(object):
 
         self.server = imagery_server
 
+        # Reuse keep-alive connections instead of reconnecting for every post.  Several
+        # threads post at once and requests.Session isn't thread-safe, so each thread
+        # gets its own.
+        self._thread_local = threading.local()
+
         logger.info("Telemeter instantiated.")
 
+    @property
+    def _session(self):
+        session = getattr(self._thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.auth = (fishface_server_auth.USERNAME, fishface_server_auth.PASSWORD)
+            self._thread_local.session = session
+        return session
+
+    def close_thread_session(self):
+        """
+        Closes the calling thread's session.  Threads that only post once should call
+        this when they are done rather than leaving the connection to the GC.
+        """
+        session = getattr(self._thread_local, 'session', None)
+        if session is not None:
+            session.close()
+            self._thread_local.session = None
+
     def post_to_fishface(self, payload, files=None):
         logger.debug('POSTing payload to remote host:\n{}'.format(payload))
 
         payload = {'payload': json.dumps(payload)}
 
-        if files is None:
-            response = requests.post(TELEMETRY_URL, auth=(fishface_server_auth.USERNAME, fishface_server_auth.PASSWORD), data=payload)
-        else:
-            response = requests.post(TELEMETRY_URL, auth=(fishface_server_auth.USERNAME, fishface_server_auth.PASSWORD), data=payload, files=files)
+        response = self._session.post(TELEMETRY_URL, data=payload, files=files)
 
         self.logger.debug('POST response code: {}'.format(response.status_code))
 
@@ -643,6 +744,10 @@ class ImageryServer(object):
         self.httpd.parent = self
         self._httpd_soon_to_be_ready = False
 
+        self.image_uploader = ImageUploader(post_method=self.telemeter.post_to_fishface,
+                                            thread_registry=self.thread_registry)
+        self.image_uploader.start()
+
         self.capturejob_controller = CaptureJobController(imagery_server=self,
                                                           thread_registry=self.thread_registry)
         self.capturejob_controller.start()
@@ -706,7 +811,7 @@ class ImageryServer(object):
         stream = io.BytesIO()
         with self.camera_lock:
             capture_time = float(time.time())
-            self.camera.capture(stream, format='jpeg')
+            self.camera.capture(stream, format='jpeg', use_video_port=USE_VIDEO_PORT)
 
         with self.pending_image_acquisitions_lock:
             self.pending_image_acquisitions -= 1
@@ -740,14 +845,9 @@ class ImageryServer(object):
         payload['current'] = float(current)
         payload['is_cal_image'] = str(is_cal_image)
 
-        stream.seek(0)
-        files = {image_filename: stream}
+        files = {image_filename: (image_filename, stream.getvalue(), 'image/jpeg')}
 
-        image_start_post_time = time.time()
-        result = self.telemeter.post_to_fishface(payload=payload, files=files)
-        logger.info(result)
-        logger.info("image {} posted in {} seconds".format(payload['filename'],
-                                                           time.time() - image_start_post_time))
+        self.image_uploader.add_upload(dict(payload), files)
 
         return payload
 
@@ -771,8 +871,8 @@ class ImageryServer(object):
         payload['async'] = True
         async_thread = threading.Thread(
             name="async_image_post_thread",
-            target=self.post_image_to_server,
-            args=(payload,)
+            target=self._run_one_shot,
+            args=(self.post_image_to_server, payload,)
         )
         async_thread.start()
 
@@ -802,7 +902,17 @@ class ImageryServer(object):
 
     def abort(self):
         for thr in self.thread_registry:
-            thr.abort()
+            if thr is not self.image_uploader:
+                thr.abort()
+
+        # Let any capture in progress finish and queue its image before the uploader
+        # stops taking new ones.
+        for thr in self.thread_registry:
+            if (isinstance(thr, CaptureJob) and thr.is_alive() and
+                    thr is not threading.current_thread()):
+                thr.join(timeout=10)
+
+        self.image_uploader.abort()
 
         self.httpd.server_close()
 
@@ -843,13 +953,20 @@ class ImageryServer(object):
 
         thread = threading.Thread(
             name='posting_psu_sensed_data',
-            target=self.post_power_supply_sensed_data,
-            args=(payload, 1,)
+            target=self._run_one_shot,
+            args=(self.post_power_supply_sensed_data, payload, 1,)
         )
         thread.start()
 
         return False
 
+    def _run_one_shot(self, method, *args):
+        # target for short-lived threads; their posting session isn't reused
+        try:
+            method(*args)
+        finally:
+            self.telemeter.close_thread_session()
+
     def post_power_supply_sensed_data(self, payload, delay=None):
         if delay is not None:
             time.sleep(delay)
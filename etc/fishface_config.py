@@ -66,6 +66,9 @@ CAMERA_CONSISTENCY_SETTINGS = [
 NORMALIZED_SHAPE = (384, 512)
 NORMALIZED_DTYPE = np.uint8
 
+# Normalize images on an OpenCL device (e.g. a GPU on cluster nodes) when one is available.
+USE_OPENCL = os.environ.get('FF_USE_OPENCL', '').lower() in ('1', 'true', 'yes')
+
 redis_hostname_file_path = path_join(VAR_RUN, 'redis.hostname')
 REDIS_HOSTNAME = str(lmu.return_text_file_contents(redis_hostname_file_path))
 REDIS_HOSTNAME = REDIS_HOSTNAME if REDIS_HOSTNAME else 'localhost'
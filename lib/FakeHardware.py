@@ -26,7 +26,7 @@ class PiCamera(object):
             self._fake_image = f.read()
             print 'fake image has size {}'.format(len(self._fake_image))
 
-    def capture(self, stream, format='jpeg'):
+    def capture(self, stream, format='jpeg', use_video_port=False):
         if self._closed:
             raise NotImplementedError("Proper errors aren't implemented on fake hardware.")
 
@@ -0,0 +1,59 @@
+"""
+Compiled per-pixel kernels for image work that OpenCV doesn't cover (or covers
+slowly).  Use these as templates for new per-pixel operations instead of
+looping over pixels in Python.
+
+Numba is optional; check HAVE_NUMBA before relying on these being fast.
+"""
+
+try:
+    import numba
+    HAVE_NUMBA = True
+    prange = numba.prange
+    njit = numba.njit(parallel=True, fastmath=True, cache=True)
+except ImportError:
+    HAVE_NUMBA = False
+    prange = xrange
+
+    def njit(func):
+        return func
+
+
+@njit
+def bgr_to_gray_u8(src, dst):
+    """
+    BT.601 luma from the first three (BGR) channels of a uint8 image, in 8-bit
+    fixed point.  Any further channels (e.g. alpha) are ignored.
+    """
+    for y in prange(src.shape[0]):
+        for x in range(src.shape[1]):
+            dst[y, x] = (29 * src[y, x, 0] + 150 * src[y, x, 1] + 77 * src[y, x, 2] + 128) >> 8
+
+
+@njit
+def threshold_u8(src, dst, thr):
+    """
+    Binary threshold matching cv2.THRESH_BINARY with maxval 255.
+    """
+    for y in prange(src.shape[0]):
+        for x in range(src.shape[1]):
+            if src[y, x] > thr:
+                dst[y, x] = 255
+            else:
+                dst[y, x] = 0
+
+
+@njit
+def gray_4x_box_u8(src, dst):
+    """
+    Shrinks a uint8 gray image by exactly 4x in each dimension.  For an exact
+    integer ratio INTER_AREA is a plain 4x4 box average, so each output pixel is
+    the rounded mean of a 4x4 block.
+    """
+    for y in prange(dst.shape[0]):
+        for x in range(dst.shape[1]):
+            total = 0
+            for dy in range(4):
+                for dx in range(4):
+                    total += int(src[4 * y + dy, 4 * x + dx])
+            dst[y, x] = (total + 8) >> 4
@@ -1,18 +1,62 @@
 import os
 import sys
+import struct
+import collections
+import threading
 
 import numpy as np
 import cv2
 import functools
 
 import etc.fishface_config as ff_conf
+import lib.ff_kernels as ff_kernels
+
+
+class _NormalizedBufferPool(object):
+    """
+    Bounded pool of scratch arrays with the normalized shape and dtype, so that
+    annotations don't allocate a fresh image buffer each time.
+    """
+
+    def __init__(self, size_exponent=3):
+        self._max_size = 2 ** size_exponent
+        self._buffers = collections.deque(self._new_buffer() for _ in xrange(self._max_size))
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_buffer():
+        return np.empty(ff_conf.NORMALIZED_SHAPE, dtype=ff_conf.NORMALIZED_DTYPE)
+
+    def acquire(self):
+        with self._lock:
+            if self._buffers:
+                return self._buffers.pop()
+        return self._new_buffer()
+
+    def release(self, arr):
+        with self._lock:
+            if len(self._buffers) < self._max_size:
+                self._buffers.append(arr)
+
+
+_POOL = _NormalizedBufferPool()
+
+
+def _is_normalized(arr):
+    return arr.shape == ff_conf.NORMALIZED_SHAPE and arr.dtype == ff_conf.NORMALIZED_DTYPE
+
+
+# Only the most recent log entries are kept for each image.
+LOG_LENGTH = 256
 
 
 def ff_operation(func):
+    fname = func.__name__
+    log_message = 'OP: ' + fname
+
     @functools.wraps(func)
     def wrapper(ff_image, *args, **kwargs):
-        fname = func.__name__
-        ff_image.log = 'OP: {}'.format(fname)
+        ff_image.log = log_message
 
         if 'FFImage' not in str(ff_image.__class__):
             raise TypeError('{} requires an FFImage object as its first argument.'.format(fname))
@@ -24,27 +68,44 @@ def ff_operation(func):
 
 
 def ff_annotation(func):
+    """
+    Decorated functions receive a scratch copy of the image that they may modify
+    freely.  For normalized images the copy is a pooled buffer that is reused as
+    soon as the function returns, so it must not outlive the call: anything kept in
+    ff_image.meta or returned has to be independent of it (copy it if need be).
+    """
+    fname = func.__name__
+    log_message = 'AN: ' + fname
+
     @functools.wraps(func)
     def wrapper(ff_image, *args, **kwargs):
-        fname = func.__name__
-        ff_image.log = 'AN: {}'.format(fname)
+        ff_image.log = log_message
 
         if 'FFImage' not in str(ff_image.__class__):
             raise TypeError('{} requires an FFImage object as its first argument.'.format(fname))
 
-        return func(ff_image.array.copy(), *args, ff_image=ff_image, **kwargs)
+        image = ff_image.array
+        if not _is_normalized(image):
+            return func(image.copy(), *args, ff_image=ff_image, **kwargs)
+
+        buf = _POOL.acquire()
+        np.copyto(buf, image)
+        try:
+            return func(buf, *args, ff_image=ff_image, **kwargs)
+        finally:
+            _POOL.release(buf)
 
     return wrapper
 
 
 def array_to_jpeg_string(arr, quality=90):
     retval, jpeg_string = cv2.imencode('.jpg', arr, (cv2.IMWRITE_JPEG_QUALITY, quality))
-    return jpeg_string.tostring()
+    return jpeg_string.tobytes()
 
 
 def image_string_to_array(image_string):
     if isinstance(image_string, basestring):
-        image_array = np.fromstring(image_string, dtype=np.uint8)
+        image_array = np.frombuffer(image_string, dtype=np.uint8)
     elif isinstance(image_string, np.ndarray):
         image_array = image_string
     else:
@@ -54,30 +115,175 @@ def image_string_to_array(image_string):
 
 def array_to_png_string(arr):
     retval, png_string = cv2.imencode('.png', arr)
-    return png_string.tostring()
+    return png_string.tobytes()
+
+
+# magic, dtype code, height, width
+_RAW_MAGIC = 'FFRAW'
+_RAW_HEADER = struct.Struct('<5sBHH')
+_RAW_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float32, np.float64)
+_RAW_DTYPE_CODES = dict((np.dtype(dtype), code) for code, dtype in enumerate(_RAW_DTYPES))
+
+
+def _raw_encode(arr):
+    """
+    Cheap in-process serialization of a 2D array: a small header followed by
+    the array's bytes.  Use PNG or JPEG for anything leaving the process.
+    """
+    if arr.ndim != 2:
+        raise InvalidSource('Raw encoding needs a 2D array, not shape {}.'.format(arr.shape))
+    try:
+        dtype_code = _RAW_DTYPE_CODES[arr.dtype]
+    except KeyError:
+        raise InvalidSource('Raw encoding does not support dtype {}.'.format(arr.dtype))
+    height, width = arr.shape
+    return (_RAW_HEADER.pack(_RAW_MAGIC, dtype_code, height, width) +
+            np.ascontiguousarray(arr).tobytes())
+
+
+def _raw_decode(raw_string):
+    magic, dtype_code, height, width = _RAW_HEADER.unpack_from(raw_string)
+    if magic != _RAW_MAGIC:
+        raise InvalidSource('Not a raw-encoded image string.')
+    arr = np.frombuffer(raw_string, dtype=_RAW_DTYPES[dtype_code], offset=_RAW_HEADER.size)
+    # operations may draw on the array in place, so hand back a writable copy
+    return arr.reshape((height, width)).copy()
+
+
+def image_string_format(image_string):
+    """
+    Returns 'raw' for strings made by _raw_encode, 'png' or 'jpeg' for those
+    formats, and 'encoded' for anything else (BMP, TIFF, ...), which is left to
+    cv2.imdecode.
+    """
+    if image_string.startswith(_RAW_MAGIC):
+        return 'raw'
+    if image_string.startswith('\x89PNG'):
+        return 'png'
+    if image_string.startswith('\xff\xd8'):
+        return 'jpeg'
+    return 'encoded'
+
+
+# BT.601 luma weights in BGR(A) order, for use with cv2.transform
+_BGR2GRAY_COEF = np.array([[0.114, 0.587, 0.299]], dtype=np.float32)
+_BGRA2GRAY_COEF = np.array([[0.114, 0.587, 0.299, 0.0]], dtype=np.float32)
+
+
+_SIMD_PREFIXES = ('SSE', 'AVX', 'NEON', 'VSX')
+
+
+def _build_info_has_simd(build_info):
+    """
+    Whether the text of cv2.getBuildInformation() shows vectorized code.  OpenCV
+    3.3+ lists CPU features on its Baseline and Dispatched lines; OpenCV 2.4 only
+    shows them as compiler flags.
+
+    >>> _build_info_has_simd('''
+    ...   CPU/HW features:
+    ...     Baseline:                    SSE SSE2 SSE3
+    ...       requested:                 SSE3
+    ...     Dispatched code generation:  SSE4_1 SSE4_2 FP16 AVX AVX2
+    ... ''')
+    True
+    >>> _build_info_has_simd('''
+    ...     Baseline:                    NEON FP16
+    ... ''')
+    True
+    >>> _build_info_has_simd('''
+    ...     Baseline:
+    ...     Dispatched code generation:
+    ... ''')
+    False
+    >>> _build_info_has_simd('''
+    ...     C++ flags (Release):         -fsigned-char -W -Wall -msse -msse2 -O3 -DNDEBUG
+    ... ''')
+    True
+    >>> _build_info_has_simd('''
+    ...     C++ flags (Release):         -fsigned-char -W -Wall -O3 -DNDEBUG
+    ... ''')
+    False
+    """
+    for line in build_info.splitlines():
+        label, _, value = line.strip().partition(':')
+        if label in ('Baseline', 'Dispatched code generation'):
+            if any(feature.startswith(_SIMD_PREFIXES) for feature in value.split()):
+                return True
+        elif label.startswith('C++ flags'):
+            if any(flag.startswith(('-msse', '-mavx')) or 'neon' in flag
+                   for flag in value.split()):
+                return True
+    return False
+
+
+# Only worth using the compiled kernels when OpenCV was built without vector code.
+_USE_KERNELS = ff_kernels.HAVE_NUMBA and not _build_info_has_simd(cv2.getBuildInformation())
+
+# e.g. 2048x1536 raspi captures, which are decoded as gray and shrink to the
+# normalized shape by exactly 4x
+_BOX_4X_SHAPE = (4 * ff_conf.NORMALIZED_SHAPE[0], 4 * ff_conf.NORMALIZED_SHAPE[1])
+
+# cv2.UMat only exists in OpenCV 3+.
+_USE_OPENCL = ff_conf.USE_OPENCL and hasattr(cv2, 'UMat') and cv2.ocl.haveOpenCL()
+if _USE_OPENCL:
+    cv2.ocl.setUseOpenCL(True)
+
+
+def _normalize_array_opencl(image, conversion):
+    umat = cv2.UMat(image)
+    if conversion is not None:
+        umat = cv2.cvtColor(umat, conversion)
+    if image.shape[:2] != ff_conf.NORMALIZED_SHAPE:
+        umat = cv2.resize(umat, dsize=tuple(reversed(ff_conf.NORMALIZED_SHAPE)),
+                          interpolation=cv2.INTER_AREA)
+    return umat.get()
 
 
 def normalize_array(image):
+    """
+    Converts image to a single channel with the normalized shape.
+    """
     if image.shape == ff_conf.NORMALIZED_SHAPE:
         return image
 
+    dsize = tuple(reversed(ff_conf.NORMALIZED_SHAPE))
+
     # too many color channels
     if len(image.shape) == 3:
         channels = image.shape[2]
         if channels == 3:
+            coefficients = _BGR2GRAY_COEF
             conversion = cv2.COLOR_BGR2GRAY
         elif channels == 4:
+            coefficients = _BGRA2GRAY_COEF
             conversion = cv2.COLOR_BGRA2GRAY
         else:
             raise Exception("Why do I see {} color channels? ".format(channels) +
                             "I can only handle 1, 3, or 4 (with alpha).")
 
-        image = cv2.cvtColor(image, conversion)
+        if _USE_OPENCL:
+            return _normalize_array_opencl(image, conversion)
+
+        # Area averaging is linear, so shrinking before mixing the channels gives
+        # the same result while the color pass only touches the small image.
+        if image.shape[:2] != ff_conf.NORMALIZED_SHAPE:
+            image = cv2.resize(image, dsize=dsize, interpolation=cv2.INTER_AREA)
+
+        if _USE_KERNELS and image.dtype == np.uint8:
+            dst = np.empty(ff_conf.NORMALIZED_SHAPE, dtype=np.uint8)
+            ff_kernels.bgr_to_gray_u8(image, dst)
+            return dst
+
+        return cv2.transform(image, coefficients)
 
     if image.shape != ff_conf.NORMALIZED_SHAPE:
-        image = cv2.resize(image,
-                           dsize=tuple(reversed(ff_conf.NORMALIZED_SHAPE)),
-                           interpolation=cv2.INTER_AREA)
+        if _USE_OPENCL:
+            return _normalize_array_opencl(image, None)
+        if _USE_KERNELS and image.shape == _BOX_4X_SHAPE and image.dtype == np.uint8:
+            dst = np.empty(ff_conf.NORMALIZED_SHAPE, dtype=np.uint8)
+            ff_kernels.gray_4x_box_u8(image, dst)
+            return dst
+        image = cv2.resize(image, dsize=dsize, interpolation=cv2.INTER_AREA)
     return image
 
 
@@ -86,6 +292,9 @@ def normalize_image_string(image_string):
 
 
 class FFImage(object):
+    __slots__ = ('meta', 'source_image_string', 'source_image_format', 'png_string',
+                 '_png_dirty', '_array', '_array_clean')
+
     def __init__(self, source=None, source_filename=None, source_dir=None,
                  meta=None, log=None,
                  store_source_image_as=None,
@@ -98,7 +307,9 @@ class FFImage(object):
             self.meta = dict()
 
         if log is None:
-            log = list()
+            log = collections.deque(maxlen=LOG_LENGTH)
+        elif not isinstance(log, collections.deque):
+            log = collections.deque(log, maxlen=LOG_LENGTH)
         self.meta['log'] = log
 
         if isinstance(source, basestring):
@@ -117,35 +328,58 @@ class FFImage(object):
                     source_filename
                 ))
 
+        image_array = None
+
         if image_string is None and isinstance(source, np.ndarray):
             if not normalize_image and (source.shape != ff_conf.NORMALIZED_SHAPE or
                                         source.dtype != ff_conf.NORMALIZED_DTYPE):
                 raise InvalidSource('input_array must have shape {} and dtype {}.'.format(
                     ff_conf.NORMALIZED_SHAPE, ff_conf.NORMALIZED_DTYPE))
 
-            image_string = array_to_png_string(source)
+            image_array = source
 
-        if image_string is None and source is not None:
+        if image_string is None and image_array is None and source is not None:
             raise Exception('None of the provided sources were usable.  Need a jpeg filename' +
                             'string, a raw jpeg as a string, or a numpy array image.')
 
-        if image_string is None:
-            image_string = array_to_png_string(np.zeros(ff_conf.NORMALIZED_SHAPE,
-                                                        dtype=ff_conf.NORMALIZED_DTYPE))
+        if image_string is None and image_array is None:
+            image_array = np.zeros(ff_conf.NORMALIZED_SHAPE, dtype=ff_conf.NORMALIZED_DTYPE)
+
+        self.png_string = None
+        # PNG is only produced at I/O boundaries; in-process images stay raw.
+        self._png_dirty = True
+
+        self._array = None
+        self._array_clean = True
+
+        if image_string is not None and not normalize_image:
+            # Encoded images that don't need normalizing (e.g. camera JPEGs on their
+            # way to storage) are kept byte for byte and only decoded if .array is used.
+            self.source_image_string = image_string
+            self.source_image_format = image_string_format(image_string)
+            self._png_dirty = False
+        elif normalize_image:
+            if image_array is None:
+                image_array = normalize_image_string(image_string)
+            else:
+                image_array = normalize_array(image_array)
+                if image_array is source:
+                    # don't let operations draw on the caller's array
+                    image_array = image_array.copy()
 
-        if normalize_image and image_string is not None:
-            image_array = normalize_image_string(image_string)
             if store_source_image_as is None or store_source_image_as is 'png':
-                self.source_image_string = array_to_png_string(image_array)
-                self.png_string = self.source_image_string
+                self.source_image_string = _raw_encode(image_array)
+                self.source_image_format = 'raw'
             else:
                 self.source_image_string = array_to_jpeg_string(image_array)
-                self.png_string = None
-        else:
-            self.source_image_string = image_string
+                self.source_image_format = 'jpeg'
+                self._png_dirty = False
 
-        self._array = None
-        self._array_clean = True
+            # keep the decoded array so .array doesn't have to decode it again
+            self._array = image_array
+        else:
+            self.source_image_string = _raw_encode(image_array)
+            self.source_image_format = 'raw'
 
         if source_filename is None:
             self.meta['source_filename'] = 'IMAGE_NOT_FROM_A_FILE.jpg'
@@ -166,8 +400,14 @@ class FFImage(object):
     def width(self):
         return self.array.shape[1]
 
+    def _get_png_string(self):
+        if self._png_dirty:
+            self.png_string = array_to_png_string(self.array)
+            self._png_dirty = False
+        return self.png_string
+
     def write_file_to_dir(self, dir_path):
-        if self.png_string:
+        if self._get_png_string():
             image_string = self.png_string
         else:
             image_string = self.source_image_string
@@ -180,6 +420,8 @@ class FFImage(object):
         if self._array is None:
             if self.png_string is not None:
                 self._array = image_string_to_array(self.png_string)
+            elif self.source_image_format == 'raw':
+                self._array = _raw_decode(self.source_image_string)
             else:
                 self._array = image_string_to_array(self.source_image_string)
 
@@ -187,14 +429,42 @@ class FFImage(object):
 
     @array.setter
     def array(self, arr):
-        self.png_string = array_to_png_string(arr)
+        # PNG encoding is deferred until something actually needs the string.
+        self.png_string = None
+        self._png_dirty = True
         if self._array_clean:
             self._array_clean = False
             if self.filename.endswith('jpg'):
                 self.meta['filename'] = self.filename[:-3] + 'png'
         self._array = arr
 
+    def __getstate__(self):
+        # Pickles go over the wire, so avoid shipping the decoded array when it can be
+        # rebuilt exactly: an unmodified image from its source string, a modified 2D
+        # uint8 one from its PNG.  Anything else (e.g. float32 from
+        # distance_transform) wouldn't survive PNG, so it is pickled as is.
+        drop_array = self._array_clean
+        if (not drop_array and self._array is not None and
+                self._array.ndim == 2 and self._array.dtype == np.uint8):
+            self._get_png_string()
+            drop_array = True
+        state = dict((slot, getattr(self, slot)) for slot in self.__slots__ if hasattr(self, slot))
+        if drop_array:
+            state['_array'] = None
+        return state
+
+    def __setstate__(self, state):
+        # unpickled dict keys aren't interned, so share them again here
+        meta = state.get('meta')
+        if meta is not None:
+            state['meta'] = dict((intern(key) if type(key) is str else key, value)
+                                 for key, value in meta.iteritems())
+        for slot, value in state.iteritems():
+            setattr(self, slot, value)
+
     def sanitize(self):
+        if not self._array_clean:
+            self._get_png_string()
         self._array = None
         del self.meta['all_contours']
 
@@ -214,7 +484,8 @@ class FFImage(object):
         if self._array is not None:
             total['array'] = self._array.nbytes
         total['jpeg_string'] = sys.getsizeof(self.source_image_string)
-        total['png_string'] = sys.getsizeof(self.png_string)
+        if self.png_string is not None:
+            total['png_string'] = sys.getsizeof(self.png_string)
         total['meta'] = sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.meta.iteritems())
         total['log'] = sum(sys.getsizeof(v) for v in self.meta['log'])
 
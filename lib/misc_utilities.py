@@ -63,7 +63,7 @@ def n_chunkify(n, chunkable):
 
 def image_string_to_array(image_string):
     if isinstance(image_string, basestring):
-        image_array = np.fromstring(image_string, dtype=np.uint8)
+        image_array = np.frombuffer(image_string, dtype=np.uint8)
     elif isinstance(image_string, np.ndarray):
         image_array = image_string
     else: